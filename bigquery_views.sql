@@ -125,4 +125,27 @@ SELECT
 FROM base
 GROUP BY age_bucket, gender, category;
 
+-- Vue matérialisée 5: Agrégats horaires des commandes (métriques et courbes du dashboard)
+-- BigQuery la rafraîchit de manière incrémentale : le dashboard ne paie que le delta
+CREATE MATERIALIZED VIEW IF NOT EXISTS `spark-streaming-483317.shopping.mv_orders_hourly` AS
+SELECT
+  TIMESTAMP_TRUNC(processed_time, HOUR) AS hour,
+  COUNT(*) AS orders,
+  SUM(purchase_amount_usd) AS revenue,
+  COUNT(purchase_amount_usd) AS amount_count,
+  SUM(review_rating) AS rating_sum,
+  COUNT(review_rating) AS rating_count,
+  COUNTIF(is_anomaly) AS anomalies,
+  COUNTIF(customer_segment = 'VIP') AS vip_orders,
+  SUM(estimated_profit_usd) AS profit,
+  SUM(final_amount_usd) AS final_revenue
+FROM `spark-streaming-483317.shopping.orders`
+GROUP BY hour;
 
+-- Optionnel : réservation BI Engine (cache mémoire en colonnes) pour les requêtes du dashboard
+-- Adapter la région (region-eu, region-us, ...) à celle du dataset
+-- ALTER BI_CAPACITY `spark-streaming-483317.region-eu.default`
+-- SET OPTIONS (
+--   size_gb = 1,
+--   preferred_tables = ['spark-streaming-483317.shopping.orders', 'spark-streaming-483317.shopping.mv_orders_hourly']
+-- );
@@ -5,14 +5,29 @@ Affiche les données depuis la table orders et les vues analytiques BigQuery
 
 import streamlit as st
 from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
 from google.oauth2 import service_account
+from requests.adapters import HTTPAdapter
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import time
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from dotenv import load_dotenv
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# BigQuery Storage Read API (optionnel) : télécharge les résultats en Arrow au lieu de pages JSON REST
+try:
+    from google.cloud import bigquery_storage
+    from google.cloud.bigquery_storage_v1.services.big_query_read.transports import BigQueryReadGrpcTransport
+except ImportError:
+    bigquery_storage = None
 
 # Charger les variables d'environnement (pour développement local)
 load_dotenv()
@@ -31,11 +46,89 @@ def get_config(key: str, default: str = "") -> str:
     # Sinon, utiliser les variables d'environnement (développement local)
     return os.getenv(key, default)
 
-PROJECT_ID = get_config("GCP_PROJECT_ID", "spark-streaming-483317")
-DATASET = get_config("BIGQUERY_DATASET", "shopping_dev")  # Par défaut: shopping_dev (environnement dev)
-TABLE = get_config("BIGQUERY_TABLE", "orders")
+# Le script est ré-exécuté à chaque rerun : la configuration est résolue une seule fois par processus
+@st.cache_resource(show_spinner=False)
+def load_bigquery_config():
+    """Résout et valide le projet, le dataset et la table BigQuery"""
+    project_id = get_config("GCP_PROJECT_ID", "spark-streaming-483317")
+    dataset = get_config("BIGQUERY_DATASET", "shopping_dev")  # Par défaut: shopping_dev (environnement dev)
+    table = get_config("BIGQUERY_TABLE", "orders")
+    
+    # Les identifiants sont interpolés dans le SQL : on les valide avant toute requête
+    for config_key, config_value in (("GCP_PROJECT_ID", project_id), ("BIGQUERY_DATASET", dataset), ("BIGQUERY_TABLE", table)):
+        if not re.fullmatch(r"[a-zA-Z0-9_\-]+", config_value):
+            raise ValueError(f"Valeur invalide pour {config_key}: {config_value!r}")
+    return project_id, dataset, table
+
+PROJECT_ID, DATASET, TABLE = load_bigquery_config()
+DATASET_ID = f"{PROJECT_ID}.{DATASET}"
+TABLE_ID = f"{DATASET_ID}.{TABLE}"
+
+# Colonnes de la table orders pouvant être sélectionnées (liste blanche pour la clause SELECT)
+ORDERS_COLUMNS = (
+    'customer_id', 'age', 'gender', 'category', 'item_purchased', 'purchase_amount_usd',
+    'location', 'review_rating', 'subscription_status', 'payment_method', 'processed_time',
+    'final_amount_usd', 'amount_category', 'customer_segment', 'satisfaction_level', 'is_anomaly',
+    'estimated_clv', 'frequency_category', 'estimated_profit_usd', 'season_type', 'loyalty_score'
+)
+
+# Colonnes des tableaux affichés (dernières commandes, VIP Premium, anomalies)
+LATEST_ORDERS_DISPLAY_COLUMNS = (
+    'processed_time', 'customer_id', 'category', 'item_purchased',
+    'purchase_amount_usd', 'final_amount_usd', 'amount_category',
+    'customer_segment', 'satisfaction_level', 'is_anomaly',
+    'location', 'review_rating'
+)
+VIP_DISPLAY_COLUMNS = (
+    'processed_time', 'customer_id', 'category', 'item_purchased',
+    'purchase_amount_usd', 'estimated_clv', 'loyalty_score',
+    'frequency_category', 'location'
+)
+ANOMALY_DISPLAY_COLUMNS = (
+    'processed_time', 'customer_id', 'category', 'purchase_amount_usd',
+    'amount_category', 'location', 'customer_segment', 'payment_method'
+)
+# Colonnes utilisées uniquement dans les métriques et agrégats
+AGGREGATED_COLUMNS = ('is_anomaly', 'estimated_clv', 'estimated_profit_usd')
+
+# Colonnes réellement affichées ou agrégées par le dashboard : seules celles-ci sont lues dans BigQuery
+DASHBOARD_COLUMNS = tuple(dict.fromkeys(
+    LATEST_ORDERS_DISPLAY_COLUMNS + VIP_DISPLAY_COLUMNS + ANOMALY_DISPLAY_COLUMNS + AGGREGATED_COLUMNS
+))
+
+# Types explicites des colonnes de la table orders (évite l'inférence de pandas)
+# Les chaînes à faible cardinalité sont stockées en Categorical (codes entiers au lieu d'objets str)
+ORDERS_DTYPES = {
+    'age': 'Int16',
+    'is_anomaly': 'boolean',
+    'purchase_amount_usd': 'float32',
+    'final_amount_usd': 'float32',
+    'review_rating': 'float32',
+    'estimated_clv': 'float32',
+    'estimated_profit_usd': 'float32',
+    'gender': 'category',
+    'category': 'category',
+    'location': 'category',
+    'amount_category': 'category',
+    'customer_segment': 'category',
+    'satisfaction_level': 'category',
+    'frequency_category': 'category',
+    'payment_method': 'category',
+    'subscription_status': 'category',
+    'season_type': 'category',
+    'loyalty_score': 'category',
+}
+
+# Ordre logique des niveaux de satisfaction (du plus satisfait au moins satisfait)
+SATISFACTION_ORDER = ['Very Satisfied', 'Satisfied', 'Neutral', 'Dissatisfied']
 
-# Authentification BigQuery
+def configure_connection_pool(client):
+    """Agrandit le pool de connexions HTTP du client BigQuery (10 par défaut) pour les sessions concurrentes"""
+    client._http.mount("https://", HTTPAdapter(pool_connections=100, pool_maxsize=100, max_retries=3))
+    client._http._auth_request.session.mount("https://", HTTPAdapter(pool_connections=100, pool_maxsize=100, max_retries=3))
+    return client
+
+# Authentification BigQuery (client unique partagé par toutes les sessions Streamlit)
 @st.cache_resource
 def init_bigquery_client():
     """Initialise le client BigQuery en utilisant les credentials GCP"""
@@ -51,7 +144,7 @@ def init_bigquery_client():
                             scopes=["https://www.googleapis.com/auth/bigquery"]
                         )
                         client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
-                        return client
+                        return configure_connection_pool(client)
                 except Exception as secrets_error:
                     # Erreur de parsing TOML ou autre erreur liée aux secrets
                     error_msg = str(secrets_error)
@@ -99,7 +192,7 @@ def init_bigquery_client():
                 scopes=["https://www.googleapis.com/auth/bigquery"]
             )
             client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
-            return client
+            return configure_connection_pool(client)
         
         # Option 3: Application Default Credentials (recommandé sur GCP/Cloud Run)
         # Forcer explicitement le project ID pour éviter les conflits avec d'anciens projets
@@ -112,13 +205,14 @@ def init_bigquery_client():
             credentials.project_id = PROJECT_ID
         client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
         
-        # Tester la connexion (optionnel - peut échouer si le dataset n'existe pas encore)
-        try:
-            client.get_dataset(f"{PROJECT_ID}.{DATASET}")
-        except Exception:
-            pass  # Ignorer l'erreur si le dataset n'existe pas encore
+        # Tester la connexion uniquement en mode debug (évite un aller-retour REST au démarrage)
+        if os.getenv("DEBUG_BQ"):
+            try:
+                client.get_dataset(DATASET_ID)
+            except Exception as probe_error:
+                st.warning(f"Dataset {DATASET_ID} inaccessible: {str(probe_error)}")
         
-        return client
+        return configure_connection_pool(client)
     except Exception as e:
         error_msg = str(e)
         st.error(f"❌ Erreur d'authentification BigQuery: {error_msg}")
@@ -156,133 +250,514 @@ def init_bigquery_client():
             """)
         raise
 
-@st.cache_data(ttl=10)  # Cache pendant 10 secondes pour réduire les appels BigQuery
-def fetch_latest_orders(limit=1000):
-    """Récupère les dernières commandes depuis BigQuery avec les colonnes enrichies"""
+@st.cache_resource
+def init_bqstorage_client():
+    """Initialise le client BigQuery Storage Read API (None si le package n'est pas installé)"""
+    if bigquery_storage is None:
+        return None
+    client = init_bigquery_client()
+    # Canal gRPC unique, multiplexé (HTTP/2) entre toutes les sessions et requêtes
+    channel = BigQueryReadGrpcTransport.create_channel(
+        credentials=client._credentials,
+        options=[
+            ("grpc.max_send_message_length", -1),
+            ("grpc.max_receive_message_length", -1),
+            ("grpc.keepalive_time_ms", 30000)
+        ]
+    )
+    return bigquery_storage.BigQueryReadClient(transport=BigQueryReadGrpcTransport(channel=channel))
+
+def submit_query(query, query_parameters=None):
+    """Soumet une requête BigQuery sans attendre le résultat (le job s'exécute côté serveur)"""
     client = init_bigquery_client()
+    # Le cache de résultats BigQuery sert gratuitement les requêtes identiques tant que la table n'a pas changé
+    job_config = bigquery.QueryJobConfig(
+        use_query_cache=True,
+        query_parameters=query_parameters or []
+    )
+    return client.query(query, job_config=job_config)
+
+def job_to_dataframe(job, dtypes=None):
+    """Attend la fin d'un job BigQuery et récupère le résultat en DataFrame via la Storage Read API"""
+    return job.to_dataframe(
+        bqstorage_client=init_bqstorage_client(),
+        create_bqstorage_client=False,
+        dtypes=dtypes
+    )
+
+def run_query(query, dtypes=None, query_parameters=None):
+    """Exécute une requête BigQuery et récupère le résultat en DataFrame"""
+    return job_to_dataframe(submit_query(query, query_parameters), dtypes=dtypes)
+
+# Les données temps réel sont mises en cache par version des données (`data_version` : date de
+# dernière modification de la table, voir fetch_table_mtime) ; le TTL couvre l'intervalle maximal du slider
+LIVE_CACHE_TTL = 60
+
+@st.cache_data(ttl=5, show_spinner=False)
+def fetch_table_mtime():
+    """Date de dernière modification de la table orders (lecture des métadonnées, aucune requête exécutée).
+    Retourne None si les métadonnées ne sont pas accessibles."""
+    try:
+        return init_bigquery_client().get_table(TABLE_ID).modified.timestamp()
+    except Exception:
+        return None
+
+def current_data_version(refresh_interval):
+    """Version courante des données : date de modification de la table orders, ou à défaut
+    (métadonnées inaccessibles) la tranche de temps courante de la durée de l'intervalle d'actualisation"""
+    data_version = fetch_table_mtime()
+    if data_version is None:
+        data_version = int(time.time() // refresh_interval)
+    return data_version
+
+@st.cache_data(ttl=LIVE_CACHE_TTL, max_entries=4, show_spinner=False)
+def fetch_latest_orders(limit=1000, columns=ORDERS_COLUMNS, since=None, data_version=0):
+    """Récupère les dernières commandes depuis BigQuery, limitées aux colonnes demandées.
+    Si `since` est fourni, seules les commandes traitées après ce timestamp sont lues.
+    Les erreurs sont propagées pour ne jamais mettre en cache un résultat vide."""
+    unknown_columns = [col for col in columns if col not in ORDERS_COLUMNS]
+    if unknown_columns:
+        raise ValueError(f"Colonnes inconnues dans la table orders: {', '.join(unknown_columns)}")
     
+    select_list = ",\n        ".join(columns)
+    where_clause = "WHERE processed_time > @since" if since is not None else ""
     query = f"""
     SELECT 
-        customer_id,
-        age,
-        gender,
-        category,
-        item_purchased,
-        purchase_amount_usd,
-        location,
-        review_rating,
-        subscription_status,
-        payment_method,
-        processed_time,
-        final_amount_usd,
-        amount_category,
-        customer_segment,
-        satisfaction_level,
-        is_anomaly,
-        estimated_clv,
-        frequency_category,
-        estimated_profit_usd,
-        season_type,
-        loyalty_score
-    FROM `{PROJECT_ID}.{DATASET}.{TABLE}`
+        {select_list}
+    FROM `{TABLE_ID}`
+    {where_clause}
     ORDER BY processed_time DESC
-    LIMIT {limit}
+    LIMIT @limit
     """
+    # Texte SQL constant quel que soit `limit` : le cache de résultats BigQuery reste exploitable
+    query_parameters = [bigquery.ScalarQueryParameter('limit', 'INT64', limit)]
+    if since is not None:
+        query_parameters.append(bigquery.ScalarQueryParameter('since', 'TIMESTAMP', since.to_pydatetime()))
+    dtypes = {col: dtype for col, dtype in ORDERS_DTYPES.items() if col in columns}
     
-    try:
-        df = client.query(query).to_dataframe()
-        return df
-    except Exception as e:
-        error_msg = str(e)
-        if "db-dtypes" in error_msg.lower():
-            st.error("❌ **Package manquant : db-dtypes**")
-            st.markdown("""
-            **Pour résoudre ce problème :**
-            
-            **Si vous êtes sur Streamlit Cloud :**
-            1. Vérifiez que vous avez poussé les modifications de `requirements.txt` sur GitHub
-            2. Attendez que Streamlit Cloud redéploie automatiquement (quelques minutes)
-            3. Vérifiez les logs pour confirmer l'installation du package
-            
-            **Si vous testez en local :**
-            ```bash
-            pip install db-dtypes
-            # Ou réinstaller toutes les dépendances :
-            pip install -r requirements.txt
-            ```
-            """)
-        else:
-            st.error(f"Erreur lors de la récupération des commandes: {error_msg}")
-        return pd.DataFrame()
+    return run_query(query, dtypes=dtypes, query_parameters=query_parameters)
 
-@st.cache_data(ttl=30)  # Cache pendant 30 secondes
-def fetch_age_preferences():
-    """Récupère les données depuis la vue v_age_preferences"""
-    client = init_bigquery_client()
-    
+def show_orders_error(e):
+    """Affiche l'erreur de récupération des commandes (avec la marche à suivre si db-dtypes manque)"""
+    error_msg = str(e)
+    if "db-dtypes" in error_msg.lower():
+        st.error("❌ **Package manquant : db-dtypes**")
+        st.markdown("""
+        **Pour résoudre ce problème :**
+        
+        **Si vous êtes sur Streamlit Cloud :**
+        1. Vérifiez que vous avez poussé les modifications de `requirements.txt` sur GitHub
+        2. Attendez que Streamlit Cloud redéploie automatiquement (quelques minutes)
+        3. Vérifiez les logs pour confirmer l'installation du package
+        
+        **Si vous testez en local :**
+        ```bash
+        pip install db-dtypes
+        # Ou réinstaller toutes les dépendances :
+        pip install -r requirements.txt
+        ```
+        """)
+    else:
+        st.error(f"Erreur lors de la récupération des commandes: {error_msg}")
+
+# Largeur des tranches de l'histogramme des montants (USD)
+AMOUNT_BUCKET_USD = 5
+
+@st.cache_data(ttl=LIVE_CACHE_TTL, max_entries=4, show_spinner=False)
+def fetch_amount_histogram(data_version=0):
+    """Calcule l'histogramme des montants dans BigQuery (quelques dizaines de tranches au lieu des lignes brutes)"""
     query = f"""
-    SELECT * FROM `{PROJECT_ID}.{DATASET}.v_age_preferences`
-    ORDER BY age_bucket
+    SELECT
+        FLOOR(purchase_amount_usd / @bucket_width) * @bucket_width AS bucket_start,
+        COUNT(*) AS orders
+    FROM `{TABLE_ID}`
+    WHERE purchase_amount_usd IS NOT NULL
+    GROUP BY bucket_start
+    ORDER BY bucket_start
     """
+    query_parameters = [bigquery.ScalarQueryParameter('bucket_width', 'FLOAT64', AMOUNT_BUCKET_USD)]
     
+    return run_query(query, query_parameters=query_parameters)
+
+def order_satisfaction_levels(orders_df):
+    """Rend satisfaction_level ordonné selon SATISFACTION_ORDER (les valeurs inattendues restent en fin de liste)"""
+    if 'satisfaction_level' in orders_df.columns:
+        levels = orders_df['satisfaction_level'].cat.categories
+        ordered_levels = [level for level in SATISFACTION_ORDER if level in levels]
+        ordered_levels += [level for level in levels if level not in SATISFACTION_ORDER]
+        orders_df['satisfaction_level'] = orders_df['satisfaction_level'].cat.set_categories(ordered_levels, ordered=True)
+    return orders_df
+
+def load_orders(limit=10000, columns=DASHBOARD_COLUMNS, data_version=0):
+    """Conserve les dernières commandes dans la session : après le premier chargement,
+    seules les commandes arrivées depuis le dernier processed_time connu sont lues dans BigQuery"""
+    cached_df = st.session_state.get('orders_df')
+    same_columns = st.session_state.get('orders_columns') == columns
+    if (cached_df is not None and not cached_df.empty and same_columns
+            and st.session_state.get('orders_version') == data_version):
+        # Table inchangée depuis le dernier chargement : aucune requête
+        return cached_df
+    incremental = cached_df is not None and not cached_df.empty and same_columns
     try:
-        df = client.query(query).to_dataframe()
-        return df
+        fetched = fetch_latest_orders(
+            limit=limit,
+            columns=columns,
+            since=cached_df['processed_time'].max() if incremental else None,
+            data_version=data_version
+        )
     except Exception as e:
-        # Si la vue n'existe pas, on retourne un DataFrame vide
-        st.warning(f"Vue v_age_preferences non disponible: {str(e)}")
-        return pd.DataFrame()
-
-@st.cache_data(ttl=30)
-def fetch_gender_preferences():
-    """Récupère les données depuis la vue v_gender_preferences"""
-    client = init_bigquery_client()
+        show_orders_error(e)
+        st.session_state['last_run_failed'] = True
+        return cached_df if incremental else pd.DataFrame()
     
-    query = f"""
-    SELECT * FROM `{PROJECT_ID}.{DATASET}.v_gender_preferences`
-    """
+    if not incremental:
+        orders_df = fetched
+    else:
+        new_rows = fetched
+        if new_rows.empty:
+            st.session_state['orders_version'] = data_version
+            return cached_df
+        # Les nouvelles lignes (triées par date décroissante) passent devant, puis on garde les `limit` plus récentes
+        orders_df = pd.concat([new_rows, cached_df], ignore_index=True).head(limit)
+        # pd.concat repasse en object les Categorical dont les modalités diffèrent
+        orders_df = orders_df.astype({
+            col: dtype for col, dtype in ORDERS_DTYPES.items()
+            if dtype == 'category' and col in orders_df.columns
+        })
     
+    orders_df = order_satisfaction_levels(orders_df)
+    st.session_state['orders_df'] = orders_df
+    st.session_state['orders_columns'] = columns
+    st.session_state['orders_version'] = data_version
+    return orders_df
+
+def query_orders_hourly(query, query_parameters=None):
+    """Exécute une requête sur la vue matérialisée mv_orders_hourly ({source} dans la requête).
+    Si la vue n'est pas encore créée, la même agrégation est calculée sur la table orders."""
     try:
-        df = client.query(query).to_dataframe()
-        return df
-    except Exception as e:
-        st.warning(f"Vue v_gender_preferences non disponible: {str(e)}")
-        return pd.DataFrame()
+        return run_query(query.format(source=f"`{DATASET_ID}.mv_orders_hourly`"), query_parameters=query_parameters)
+    except NotFound:
+        rollup = f"""(
+        SELECT
+            TIMESTAMP_TRUNC(processed_time, HOUR) AS hour,
+            COUNT(*) AS orders,
+            SUM(purchase_amount_usd) AS revenue,
+            COUNT(purchase_amount_usd) AS amount_count,
+            SUM(review_rating) AS rating_sum,
+            COUNT(review_rating) AS rating_count,
+            COUNTIF(is_anomaly) AS anomalies,
+            COUNTIF(customer_segment = 'VIP') AS vip_orders,
+            SUM(estimated_profit_usd) AS profit,
+            SUM(final_amount_usd) AS final_revenue
+        FROM `{TABLE_ID}`
+        GROUP BY hour
+    )"""
+        return run_query(query.format(source=rollup), query_parameters=query_parameters)
 
-@st.cache_data(ttl=30)
-def fetch_location_preferences():
-    """Récupère les données depuis la vue v_location_preferences"""
-    client = init_bigquery_client()
-    
-    query = f"""
-    SELECT * FROM `{PROJECT_ID}.{DATASET}.v_location_preferences`
-    ORDER BY orders DESC
+@st.cache_data(ttl=LIVE_CACHE_TTL, max_entries=4, show_spinner=False)
+def fetch_kpis(data_version=0):
+    """Calcule les métriques principales depuis les agrégats horaires (une seule ligne)"""
+    query = """
+    SELECT
+        IFNULL(SUM(orders), 0) AS total_orders,
+        IFNULL(SUM(revenue), 0) AS total_revenue,
+        IFNULL(SAFE_DIVIDE(SUM(revenue), SUM(amount_count)), 0) AS avg_order_value,
+        IFNULL(SAFE_DIVIDE(SUM(rating_sum), SUM(rating_count)), 0) AS avg_rating,
+        IFNULL(SUM(anomalies), 0) AS anomalies_count,
+        IFNULL(SUM(profit), 0) AS total_profit,
+        IFNULL(SUM(vip_orders), 0) AS vip_customers,
+        IFNULL(SUM(final_revenue), 0) AS final_revenue
+    FROM {source}
+    """
+    return query_orders_hourly(query)
+
+# Fenêtre des courbes horaires de la vue d'ensemble
+HOURLY_WINDOW_HOURS = 48
+
+@st.cache_data(ttl=LIVE_CACHE_TTL, max_entries=4, show_spinner=False)
+def fetch_hourly(data_version=0):
+    """Récupère le nombre de commandes et les revenus par heure sur les HOURLY_WINDOW_HOURS dernières heures
+    depuis les agrégats horaires (série de taille fixe, quelle que soit la durée du streaming)"""
+    query = """
+    SELECT
+        hour,
+        orders,
+        IFNULL(revenue, 0) AS revenue
+    FROM {source}
+    WHERE hour >= @since
+    ORDER BY hour
     """
+    # Borne arrondie à l'heure : texte et paramètres identiques pendant une heure, le cache BigQuery reste exploitable
+    since = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=HOURLY_WINDOW_HOURS)
+    query_parameters = [bigquery.ScalarQueryParameter('since', 'TIMESTAMP', since)]
+    return query_orders_hourly(query, query_parameters=query_parameters)
+
+@st.cache_data(ttl=30, show_spinner=False)  # Cache pendant 30 secondes
+def fetch_analytics_views():
+    """Récupère les vues analytiques en un seul aller-retour :
+    tous les jobs sont soumis avant d'attendre le premier résultat, BigQuery les exécute en parallèle.
+    Retourne les vues et la liste des avertissements, affichés ensuite depuis le thread principal."""
+    queries = {
+        'v_age_preferences': f"""
+        SELECT * FROM `{DATASET_ID}.v_age_preferences`
+        ORDER BY age_bucket
+        """,
+        'v_gender_preferences': f"""
+        SELECT * FROM `{DATASET_ID}.v_gender_preferences`
+        """,
+        # Déjà trié et limité au Top 20 : prêt pour les graphiques sans retraitement côté client
+        'v_location_preferences': f"""
+        SELECT location, orders, avg_spend, top_categories
+        FROM `{DATASET_ID}.v_location_preferences`
+        ORDER BY orders DESC
+        LIMIT 20
+        """,
+        'v_age_gender_category': f"""
+        SELECT * FROM `{DATASET_ID}.v_age_gender_category`
+        ORDER BY orders DESC
+        LIMIT 50
+        """,
+        # Matrice âge × genre calculée par BigQuery (quelques cellules au lieu des lignes détaillées)
+        'v_age_gender_category (pivot)': f"""
+        SELECT * FROM (
+            SELECT age_bucket, gender, orders
+            FROM `{DATASET_ID}.v_age_gender_category`
+        )
+        PIVOT (SUM(orders) FOR gender IN ('Male', 'Female', 'Other'))
+        ORDER BY age_bucket
+        """,
+    }
     
-    try:
-        df = client.query(query).to_dataframe()
-        return df
-    except Exception as e:
-        st.warning(f"Vue v_location_preferences non disponible: {str(e)}")
-        return pd.DataFrame()
+    jobs = {}
+    warnings = []
+    for view, query in queries.items():
+        try:
+            jobs[view] = submit_query(query)
+        except Exception as e:
+            warnings.append(f"Vue {view} non disponible: {str(e)}")
+    
+    views = {}
+    for view in queries:
+        views[view] = pd.DataFrame()
+        if view not in jobs:
+            continue
+        try:
+            views[view] = job_to_dataframe(jobs[view])
+        except Exception as e:
+            # Si la vue n'existe pas, on retourne un DataFrame vide
+            warnings.append(f"Vue {view} non disponible: {str(e)}")
+    return views, warnings
 
-@st.cache_data(ttl=30)
-def fetch_age_gender_category():
-    """Récupère les données depuis la vue v_age_gender_category"""
-    client = init_bigquery_client()
+@st.cache_resource(show_spinner=False)
+def get_query_executor():
+    """Pool de threads partagé par toutes les sessions pour paralléliser les requêtes BigQuery"""
+    return ThreadPoolExecutor(max_workers=6, thread_name_prefix="bigquery-fetch")
+
+# Les fonctions exécutées dans le pool n'affichent rien : les erreurs remontent avec le résultat
+# et sont affichées par fetch_all depuis le thread principal
+FETCH_ERROR_MESSAGES = {
+    'kpis': "Erreur lors du calcul des métriques",
+    'hourly': "Erreur lors de l'agrégation horaire",
+    'amount_histogram': "Erreur lors du calcul de l'histogramme des montants",
+}
+
+def run_with_script_context(ctx, func):
+    """Exécute `func` dans un thread du pool en lui rattachant le contexte Streamlit de la session
+    (nécessaire pour le cache des fonctions fetch_*)"""
+    add_script_run_ctx(threading.current_thread(), ctx)
+    return func()
+
+def fetch_all(limit=10000, columns=DASHBOARD_COLUMNS, data_version=0):
+    """Lance toutes les récupérations d'un rafraîchissement en parallèle :
+    la durée totale est celle de la requête la plus lente au lieu de leur somme"""
+    # Clients créés dans le thread principal avant de les partager entre les threads du pool
+    init_bigquery_client()
+    init_bqstorage_client()
     
-    query = f"""
-    SELECT * FROM `{PROJECT_ID}.{DATASET}.v_age_gender_category`
-    ORDER BY orders DESC
-    LIMIT 50
-    """
+    ctx = get_script_run_ctx()
+    executor = get_query_executor()
+    futures = {
+        name: executor.submit(run_with_script_context, ctx, func)
+        for name, func in (
+            ('kpis', partial(fetch_kpis, data_version=data_version)),
+            ('hourly', partial(fetch_hourly, data_version=data_version)),
+            ('amount_histogram', partial(fetch_amount_histogram, data_version=data_version)),
+            ('views', fetch_analytics_views),
+        )
+    }
     
-    try:
-        df = client.query(query).to_dataframe()
-        return df
-    except Exception as e:
-        st.warning(f"Vue v_age_gender_category non disponible: {str(e)}")
-        return pd.DataFrame()
+    # Les commandes restent chargées dans le thread principal (état conservé dans st.session_state)
+    orders_df = load_orders(limit=limit, columns=columns, data_version=data_version)
+    
+    results = {}
+    for name, error_message in FETCH_ERROR_MESSAGES.items():
+        try:
+            results[name] = futures[name].result()
+        except Exception as e:
+            st.error(f"{error_message}: {str(e)}")
+            st.session_state['last_run_failed'] = True
+            results[name] = pd.DataFrame()
+    views, view_warnings = futures['views'].result()
+    for warning in view_warnings:
+        st.warning(warning)
+    
+    dashboard_data = {
+        'kpis': results['kpis'],
+        'hourly': results['hourly'],
+        'amount_histogram': results['amount_histogram'],
+        'age_preferences': views['v_age_preferences'],
+        'gender_preferences': views['v_gender_preferences'],
+        'location_preferences': views['v_location_preferences'],
+        'age_gender_category': views['v_age_gender_category'],
+        'age_gender_pivot': views['v_age_gender_category (pivot)'],
+    }
+    return orders_df, dashboard_data
+
+def orders_fingerprint(df):
+    """Empreinte O(1) d'une version des commandes (nombre de lignes, dernier processed_time, colonnes),
+    utilisée comme clé de cache à la place du hachage complet du DataFrame"""
+    last_ts = df['processed_time'].max().value if 'processed_time' in df.columns and not df.empty else 0
+    return (len(df), last_ts, tuple(df.columns))
+
+ORDERS_HASH_FUNCS = {pd.DataFrame: orders_fingerprint}
+
+def compute_category_stats(orders_df):
+    """Calcule en un seul passage le nombre de commandes et les revenus par catégorie"""
+    return orders_df.groupby('category', observed=True, sort=False).agg(
+        count=('purchase_amount_usd', 'size'),
+        revenue=('purchase_amount_usd', 'sum')
+    )
+
+def agg_value_counts(df, column):
+    """Répartition des commandes selon les valeurs d'une colonne"""
+    counts = df[column].value_counts()
+    # Sur un Categorical, value_counts liste aussi les modalités absentes du sous-ensemble
+    return counts[counts > 0]
+
+def agg_vip_category(vip_premium_df):
+    """Nombre, revenus, montant moyen et CLV moyenne par catégorie pour les clients VIP Premium"""
+    aggregations = {
+        'count': ('purchase_amount_usd', 'count'),
+        'total_revenue': ('purchase_amount_usd', 'sum'),
+        'avg_amount': ('purchase_amount_usd', 'mean'),
+    }
+    if 'estimated_clv' in vip_premium_df.columns:
+        aggregations['avg_clv'] = ('estimated_clv', 'mean')
+    vip_category = vip_premium_df.groupby('category', observed=True, sort=False, as_index=False).agg(**aggregations)
+    return vip_category.sort_values('total_revenue', ascending=False)
+
+def agg_anomalies_by(anomalies_df, key):
+    """Nombre et montant total des anomalies par valeur de `key`, triés par montant décroissant"""
+    anom_by_key = anomalies_df.groupby(key, observed=True, sort=False, as_index=False).agg(
+        count=('purchase_amount_usd', 'count'),
+        total=('purchase_amount_usd', 'sum')
+    )
+    return anom_by_key.sort_values('total', ascending=False)
+
+def agg_revenue_by_segment(orders_df):
+    """Revenus, panier moyen, volume et profit par segment client"""
+    aggregations = {
+        'total_revenue': ('purchase_amount_usd', 'sum'),
+        'avg_revenue': ('purchase_amount_usd', 'mean'),
+        'count': ('purchase_amount_usd', 'count'),
+    }
+    if 'estimated_profit_usd' in orders_df.columns:
+        aggregations['total_profit'] = ('estimated_profit_usd', 'sum')
+    revenue_by_segment = orders_df.groupby('customer_segment', observed=True, sort=False, as_index=False).agg(**aggregations)
+    revenue_by_segment = revenue_by_segment.rename(columns={'customer_segment': 'segment'})
+    return revenue_by_segment.sort_values('total_revenue', ascending=False)
+
+def agg_satisfaction_by_category(orders_df):
+    """Nombre de commandes et revenus par catégorie et niveau de satisfaction, en format long
+    et en matrice catégorie × satisfaction (dérivée du même regroupement, sans second passage)"""
+    # Regroupement trié (sort=True) : avec sort=False, les niveaux suivraient l'ordre d'arrivée des lignes
+    grouped = orders_df.groupby(['category', 'satisfaction_level'], observed=True, sort=True).agg(
+        count=('purchase_amount_usd', 'count'),
+        revenue=('purchase_amount_usd', 'sum')
+    )
+    satisfaction_by_category = grouped.reset_index()
+    
+    # Les colonnes suivent l'ordre des modalités de satisfaction_level (voir order_satisfaction_levels),
+    # les lignes l'ordre des catégories
+    pivot_satisfaction = grouped['count'].unstack(fill_value=0)
+    return satisfaction_by_category, pivot_satisfaction
+
+@st.cache_data(show_spinner=False, hash_funcs=ORDERS_HASH_FUNCS)
+def compute_bundle(orders_df):
+    """Calcule en une fois, par version des commandes, tous les agrégats affichés dans les onglets.
+    Les masques VIP Premium et anomalies sont conservés pour que les onglets extraient leurs lignes sans recalcul."""
+    columns = orders_df.columns
+    bundle = {'category_stats': compute_category_stats(orders_df)}
+    
+    if 'customer_segment' in columns and 'amount_category' in columns:
+        vip_mask = ((orders_df['customer_segment'] == 'VIP').to_numpy() &
+                    (orders_df['amount_category'] == 'Premium').to_numpy())
+        bundle['vip_mask'] = vip_mask
+        if vip_mask.any():
+            vip_premium_df = orders_df.loc[vip_mask]
+            # Seules les colonnes utiles au regroupement
+            vip_group_cols = [c for c in ('category', 'purchase_amount_usd', 'estimated_clv') if c in columns]
+            bundle['vip_category'] = agg_vip_category(vip_premium_df[vip_group_cols])
+            if 'loyalty_score' in columns:
+                bundle['loyalty_dist'] = agg_value_counts(vip_premium_df, 'loyalty_score')
+    
+    if 'is_anomaly' in columns:
+        # is_anomaly est un booléen nullable : les valeurs manquantes comptent comme non anormales
+        anomaly_mask = orders_df['is_anomaly'].to_numpy(dtype=bool, na_value=False)
+        bundle['anomaly_mask'] = anomaly_mask
+        if anomaly_mask.any():
+            anomalies_df = orders_df.loc[anomaly_mask]
+            bundle['anom_by_category'] = agg_anomalies_by(anomalies_df, 'category')
+            if 'location' in columns:
+                bundle['anom_by_location'] = agg_anomalies_by(anomalies_df, 'location').head(15)
+    
+    if 'customer_segment' in columns:
+        bundle['revenue_by_segment'] = agg_revenue_by_segment(orders_df)
+    
+    if 'satisfaction_level' in columns and 'category' in columns:
+        bundle['satisfaction_by_category'], bundle['pivot_satisfaction'] = agg_satisfaction_by_category(orders_df)
+        bundle['satisfaction_dist'] = agg_value_counts(orders_df, 'satisfaction_level')
+    
+    for column in ('amount_category', 'frequency_category'):
+        if column in columns:
+            bundle[f'{column}_dist'] = agg_value_counts(orders_df, column)
+    return bundle
+
+# `uirevision` fixe conserve le zoom et la sélection de l'utilisateur entre deux actualisations automatiques
+def make_hourly_fig(hourly_orders, column, name, title, yaxis_title, color):
+    """Construit la courbe horaire d'une colonne des agrégats horaires"""
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=hourly_orders['hour'],
+        y=hourly_orders[column],
+        mode='lines+markers',
+        name=name,
+        line=dict(color=color, width=2),
+        fill='tonexty'
+    ))
+    fig.update_layout(
+        title=title,
+        xaxis_title="Heure",
+        yaxis_title=yaxis_title,
+        hovermode='x unified',
+        height=400,
+        uirevision=column
+    )
+    return fig
+
+def make_top_categories_fig(top_categories, title, x_label, color_scale):
+    """Construit le graphique en barres horizontales d'un Top catégories"""
+    fig = px.bar(
+        x=top_categories.values,
+        y=top_categories.index,
+        orientation='h',
+        title=title,
+        labels={'x': x_label, 'y': 'Catégorie'},
+        color=top_categories.values,
+        color_continuous_scale=color_scale
+    )
+    fig.update_layout(yaxis={'categoryorder': 'total ascending'}, height=400, uirevision=title)
+    return fig
 
 # Configuration de la page
 st.set_page_config(
@@ -310,30 +785,679 @@ with st.sidebar:
         st.info(f"Actualisation toutes les {refresh_interval} secondes")
     
     if st.button("🔄 Actualiser maintenant"):
-        st.cache_data.clear()
+        # Seules les données temps réel sont invalidées, les vues analytiques gardent leur cache
+        fetch_latest_orders.clear()
+        fetch_kpis.clear()
+        fetch_hourly.clear()
+        fetch_amount_histogram.clear()
+        fetch_table_mtime.clear()
+        st.session_state.pop('orders_version', None)
         st.success("Données actualisées!")
     
+    if st.button("♻️ Tout recharger"):
+        st.cache_data.clear()
+        st.session_state.pop('orders_df', None)
+        st.success("Toutes les données ont été rechargées!")
+    
     st.markdown("---")
     st.markdown("### 📊 Informations")
     st.markdown("Ce dashboard affiche les données en temps réel depuis BigQuery.")
     st.markdown("Les données sont mises à jour automatiquement par le Consumer Spark.")
 
+def show_df(df, columns=None, max_rows=500):
+    """Affiche au plus `max_rows` lignes des colonnes demandées (taille constante envoyée au navigateur)"""
+    columns = [col for col in columns if col in df.columns] if columns is not None else list(df.columns)
+    st.dataframe(df.iloc[:max_rows].loc[:, columns], use_container_width=True, hide_index=True)
+    st.caption(f"Affiche {min(len(df), max_rows)} lignes sur {len(df)} total")
+
+# Rendu des onglets : chaque onglet est un fragment, une interaction dans un onglet ne relance que celui-ci
+@st.fragment
+def render_tab_overview(dashboard_data, bundle):
+    """Onglet Vue d'ensemble : évolution horaire, top catégories et distribution des montants"""
+    st.subheader("Dernières commandes - Vue d'ensemble")
+    
+    # Graphique temporal des commandes (agrégé par heure dans BigQuery)
+    hourly_orders = dashboard_data['hourly']
+    if not hourly_orders.empty:
+        col_left, col_right = st.columns(2)
+        
+        with col_left:
+            fig1 = make_hourly_fig(
+                hourly_orders[['hour', 'orders']],
+                column='orders',
+                name='Nombre de commandes',
+                title=f"Évolution du nombre de commandes (par heure, {HOURLY_WINDOW_HOURS} dernières heures)",
+                yaxis_title="Nombre de commandes",
+                color='#1f77b4'
+            )
+            st.plotly_chart(fig1, use_container_width=True)
+        
+        with col_right:
+            fig2 = make_hourly_fig(
+                hourly_orders[['hour', 'revenue']],
+                column='revenue',
+                name='Revenus (USD)',
+                title=f"Évolution des revenus (par heure, {HOURLY_WINDOW_HOURS} dernières heures)",
+                yaxis_title="Revenus (USD)",
+                color='#2ca02c'
+            )
+            st.plotly_chart(fig2, use_container_width=True)
+    
+    # Top catégories
+    st.markdown("### Top Catégories")
+    col_cat1, col_cat2 = st.columns(2)
+    category_stats = bundle['category_stats']
+    
+    with col_cat1:
+        fig3 = make_top_categories_fig(
+            category_stats['count'].nlargest(10),
+            title="Top 10 Catégories (Volume)",
+            x_label='Nombre de commandes',
+            color_scale='Blues'
+        )
+        st.plotly_chart(fig3, use_container_width=True)
+    
+    with col_cat2:
+        fig4 = make_top_categories_fig(
+            category_stats['revenue'].nlargest(10),
+            title="Top 10 Catégories (Revenus)",
+            x_label='Revenus (USD)',
+            color_scale='Greens'
+        )
+        st.plotly_chart(fig4, use_container_width=True)
+    
+    # Distribution des montants
+    st.markdown("### Distribution des Montants")
+    amount_histogram = dashboard_data['amount_histogram']
+    if not amount_histogram.empty:
+        fig5 = px.bar(
+            amount_histogram,
+            x='bucket_start',
+            y='orders',
+            title="Distribution des montants de commandes",
+            labels={'bucket_start': 'Montant (USD)', 'orders': 'Nombre de commandes'}
+        )
+        # Barres alignées sur le début de chaque tranche, sans espace (rendu histogramme)
+        fig5.update_traces(width=AMOUNT_BUCKET_USD, offset=0)
+        fig5.update_layout(bargap=0, uirevision='fig5')
+        st.plotly_chart(fig5, use_container_width=True)
+
+@st.fragment
+def render_tab_age(dashboard_data):
+    """Onglet Par Âge : préférences par tranche d'âge (vue v_age_preferences)"""
+    st.subheader("Préférences par tranche d'âge")
+    age_df = dashboard_data['age_preferences']
+    
+    if not age_df.empty:
+        col_a1, col_a2 = st.columns(2)
+        
+        with col_a1:
+            fig_age1 = px.bar(
+                age_df,
+                x='age_bucket',
+                y='orders',
+                title="Nombre de commandes par tranche d'âge",
+                labels={'orders': 'Nombre de commandes', 'age_bucket': 'Tranche d\'âge'},
+                color='orders',
+                color_continuous_scale='Viridis'
+            )
+            fig_age1.update_layout(uirevision='fig_age1')
+            st.plotly_chart(fig_age1, use_container_width=True)
+        
+        with col_a2:
+            fig_age2 = px.bar(
+                age_df,
+                x='age_bucket',
+                y='avg_spend',
+                title="Dépense moyenne par tranche d'âge",
+                labels={'avg_spend': 'Dépense moyenne (USD)', 'age_bucket': 'Tranche d\'âge'},
+                color='avg_spend',
+                color_continuous_scale='Plasma'
+            )
+            fig_age2.update_layout(uirevision='fig_age2')
+            st.plotly_chart(fig_age2, use_container_width=True)
+        
+        col_a3, col_a4 = st.columns(2)
+        
+        with col_a3:
+            fig_age3 = px.bar(
+                age_df,
+                x='age_bucket',
+                y='avg_rating',
+                title="Note moyenne par tranche d'âge",
+                labels={'avg_rating': 'Note moyenne', 'age_bucket': 'Tranche d\'âge'},
+                color='avg_rating',
+                color_continuous_scale='Viridis'
+            )
+            fig_age3.update_layout(uirevision='fig_age3')
+            st.plotly_chart(fig_age3, use_container_width=True)
+        
+        with col_a4:
+            if 'top_category' in age_df.columns:
+                fig_age4 = px.bar(
+                    age_df,
+                    x='age_bucket',
+                    y='top_category',
+                    orientation='h',
+                    title="Catégorie préférée par tranche d'âge",
+                    labels={'top_category': 'Catégorie', 'age_bucket': 'Tranche d\'âge'},
+                    color='age_bucket'
+                )
+                fig_age4.update_layout(uirevision='fig_age4')
+                st.plotly_chart(fig_age4, use_container_width=True)
+        
+        st.markdown("### Tableau détaillé")
+        st.dataframe(age_df, use_container_width=True, hide_index=True)
+    else:
+        st.info("Les vues analytiques ne sont pas encore disponibles. Assurez-vous que les vues BigQuery sont créées.")
+
+@st.fragment
+def render_tab_gender(dashboard_data):
+    """Onglet Par Genre : préférences par genre (vue v_gender_preferences)"""
+    st.subheader("Préférences par genre")
+    gender_df = dashboard_data['gender_preferences']
+    
+    if not gender_df.empty:
+        col_g1, col_g2 = st.columns(2)
+        
+        with col_g1:
+            fig_gen1 = go.Figure(go.Pie(labels=gender_df['gender'], values=gender_df['orders'], hole=0.4))
+            fig_gen1.update_layout(title="Répartition des commandes par genre", uirevision='fig_gen1')
+            st.plotly_chart(fig_gen1, use_container_width=True)
+        
+        with col_g2:
+            fig_gen2 = px.bar(
+                gender_df,
+                x='gender',
+                y='avg_spend',
+                title="Dépense moyenne par genre",
+                labels={'avg_spend': 'Dépense moyenne (USD)', 'gender': 'Genre'},
+                color='gender',
+                color_discrete_sequence=px.colors.qualitative.Set2
+            )
+            fig_gen2.update_layout(uirevision='fig_gen2')
+            st.plotly_chart(fig_gen2, use_container_width=True)
+        
+        col_g3, col_g4 = st.columns(2)
+        
+        with col_g3:
+            fig_gen3 = px.bar(
+                gender_df,
+                x='gender',
+                y='avg_rating',
+                title="Note moyenne par genre",
+                labels={'avg_rating': 'Note moyenne', 'gender': 'Genre'},
+                color='gender',
+                color_discrete_sequence=px.colors.qualitative.Set3
+            )
+            fig_gen3.update_layout(uirevision='fig_gen3')
+            st.plotly_chart(fig_gen3, use_container_width=True)
+        
+        with col_g4:
+            if 'top_category' in gender_df.columns:
+                fig_gen4 = px.bar(
+                    gender_df,
+                    x='gender',
+                    y='top_category',
+                    orientation='h',
+                    title="Catégorie préférée par genre",
+                    labels={'top_category': 'Catégorie', 'gender': 'Genre'},
+                    color='gender',
+                    color_discrete_sequence=px.colors.qualitative.Pastel
+                )
+                fig_gen4.update_layout(uirevision='fig_gen4')
+                st.plotly_chart(fig_gen4, use_container_width=True)
+        
+        st.markdown("### Tableau détaillé")
+        st.dataframe(gender_df, use_container_width=True, hide_index=True)
+    else:
+        st.info("Les vues analytiques ne sont pas encore disponibles.")
+
+@st.fragment
+def render_tab_location(dashboard_data):
+    """Onglet Par Localisation : préférences par localisation (vue v_location_preferences)"""
+    st.subheader("Préférences par localisation")
+    location_df = dashboard_data['location_preferences']
+    
+    if not location_df.empty:
+        fig_loc1 = px.bar(
+            location_df,
+            x='location',
+            y='orders',
+            title="Top 20 Localisations (Nombre de commandes)",
+            labels={'orders': 'Nombre de commandes', 'location': 'Localisation'},
+            color='orders',
+            color_continuous_scale='Blues'
+        )
+        fig_loc1.update_layout(xaxis_tickangle=45, uirevision='fig_loc1')
+        st.plotly_chart(fig_loc1, use_container_width=True)
+        
+        col_loc1, col_loc2 = st.columns(2)
+        
+        with col_loc1:
+            fig_loc2 = px.bar(
+                location_df.head(15),
+                x='location',
+                y='avg_spend',
+                title="Dépense moyenne par localisation (Top 15)",
+                labels={'avg_spend': 'Dépense moyenne (USD)', 'location': 'Localisation'},
+                color='avg_spend',
+                color_continuous_scale='Greens'
+            )
+            fig_loc2.update_layout(xaxis_tickangle=45, uirevision='fig_loc2')
+            st.plotly_chart(fig_loc2, use_container_width=True)
+        
+        with col_loc2:
+            # Graphique en treemap si disponible
+            if len(location_df) > 0:
+                fig_loc3 = px.treemap(
+                    location_df,
+                    path=['location'],
+                    values='orders',
+                    title="Répartition des commandes par localisation (Treemap)",
+                    color='avg_spend',
+                    color_continuous_scale='Viridis'
+                )
+                st.plotly_chart(fig_loc3, use_container_width=True)
+        
+        st.markdown("### Tableau détaillé (Top 20)")
+        st.dataframe(location_df, use_container_width=True, hide_index=True)
+    else:
+        st.info("Les vues analytiques ne sont pas encore disponibles.")
+
+@st.fragment
+def render_tab_combinations(dashboard_data):
+    """Onglet Combinaisons : analyse âge × genre × catégorie (vue v_age_gender_category)"""
+    st.subheader("Analyse combinée Âge × Genre × Catégorie")
+    age_gender_df = dashboard_data['age_gender_category']
+    
+    if not age_gender_df.empty:
+        # Heatmap (matrice déjà pivotée par BigQuery, genres absents retirés)
+        pivot_df = dashboard_data['age_gender_pivot']
+        if not pivot_df.empty:
+            pivot_df = pivot_df.set_index('age_bucket').dropna(axis=1, how='all').fillna(0)
+            
+            fig_heat = px.imshow(
+                pivot_df,
+                labels=dict(x="Genre", y="Tranche d'âge", color="Nombre de commandes"),
+                title="Heatmap: Commandes par Âge et Genre",
+                color_continuous_scale='YlOrRd',
+                aspect="auto"
+            )
+            st.plotly_chart(fig_heat, use_container_width=True)
+        
+        # Graphique 3D ou barres groupées
+        fig_comb = px.bar(
+            age_gender_df.head(30),
+            x='category',
+            y='orders',
+            color='gender',
+            facet_row='age_bucket',
+            title="Commandes par Catégorie, Genre et Âge (Top 30)",
+            labels={'orders': 'Nombre de commandes', 'category': 'Catégorie'}
+        )
+        fig_comb.update_layout(xaxis_tickangle=45, uirevision='fig_comb')
+        st.plotly_chart(fig_comb, use_container_width=True)
+        
+        st.markdown("### Tableau détaillé")
+        st.dataframe(age_gender_df, use_container_width=True, hide_index=True)
+    else:
+        st.info("Les vues analytiques ne sont pas encore disponibles.")
+
+@st.fragment
+def render_tab_vip(orders_df, bundle):
+    """Onglet Clients VIP & Premium : transactions des clients VIP avec achats Premium"""
+    st.subheader("👑 Analyse des Clients VIP avec Achats Premium")
+    
+    # Filtrer les clients VIP avec achats Premium
+    if 'customer_segment' in orders_df.columns and 'amount_category' in orders_df.columns:
+        vip_premium_df = orders_df.loc[bundle['vip_mask']]
+        
+        if not vip_premium_df.empty:
+            # Colonnes extraites une seule fois en tableaux numpy pour les métriques ci-dessous
+            vip_amounts = vip_premium_df['purchase_amount_usd'].to_numpy(dtype=np.float64)
+            vip_clv = (vip_premium_df['estimated_clv'].to_numpy(dtype=np.float64)
+                       if 'estimated_clv' in vip_premium_df.columns else None)
+            col_vip1, col_vip2 = st.columns(2)
+            
+            with col_vip1:
+                st.metric("Nombre de transactions VIP Premium", len(vip_premium_df))
+                st.metric("Revenus VIP Premium", f"${np.nansum(vip_amounts):,.2f}")
+            
+            with col_vip2:
+                avg_vip_premium = float(np.nanmean(vip_amounts))
+                avg_clv_vip = float(np.nanmean(vip_clv)) if vip_clv is not None else 0
+                st.metric("Panier Moyen VIP Premium", f"${avg_vip_premium:,.2f}")
+                st.metric("CLV Moyen", f"${avg_clv_vip:,.2f}")
+            
+            # Répartition par catégorie pour VIP Premium
+            st.markdown("### Répartition par Catégorie")
+            vip_category = bundle['vip_category']
+            
+            col_vip3, col_vip4 = st.columns(2)
+            
+            with col_vip3:
+                fig_vip1 = px.bar(
+                    vip_category,
+                    x='category',
+                    y='total_revenue',
+                    title="Revenus par Catégorie (VIP Premium)",
+                    labels={'total_revenue': 'Revenus (USD)', 'category': 'Catégorie'},
+                    color='total_revenue',
+                    color_continuous_scale='Gold'
+                )
+                fig_vip1.update_layout(xaxis_tickangle=45, uirevision='fig_vip1')
+                st.plotly_chart(fig_vip1, use_container_width=True)
+            
+            with col_vip4:
+                if 'loyalty_dist' in bundle:
+                    loyalty_dist = bundle['loyalty_dist']
+                    fig_vip2 = go.Figure(go.Pie(labels=loyalty_dist.index.tolist(), values=loyalty_dist.values, hole=0.4))
+                    fig_vip2.update_layout(title="Répartition par Score de Fidélité (VIP Premium)", uirevision='fig_vip2')
+                    st.plotly_chart(fig_vip2, use_container_width=True)
+            
+            st.markdown("### Tableau détaillé VIP Premium")
+            show_df(vip_premium_df, VIP_DISPLAY_COLUMNS, max_rows=100)
+        else:
+            st.info("Aucune transaction VIP Premium trouvée.")
+    else:
+        st.warning("Les colonnes customer_segment et amount_category ne sont pas disponibles.")
+
+@st.fragment
+def render_tab_anomalies(orders_df, bundle):
+    """Onglet Détection d'Anomalies : transactions suspectes"""
+    st.subheader("🚨 Détection des Transactions Suspectes (Anomalies)")
+    
+    if 'is_anomaly' in orders_df.columns:
+        anomaly_mask = bundle['anomaly_mask']
+        anomalies_df = orders_df.loc[anomaly_mask]
+        
+        if not anomalies_df.empty:
+            # Métriques calculées directement sur le masque et le tableau numpy des montants
+            anomaly_count = int(anomaly_mask.sum())
+            anom_amounts = anomalies_df['purchase_amount_usd'].to_numpy(dtype=np.float64)
+            col_anom1, col_anom2, col_anom3 = st.columns(3)
+            
+            with col_anom1:
+                st.metric("🚨 Transactions Anormales", anomaly_count)
+            with col_anom2:
+                anomaly_rate = 100.0 * anomaly_count / anomaly_mask.size
+                st.metric("Taux d'Anomalies", f"{anomaly_rate:.2f}%")
+            with col_anom3:
+                st.metric("Montant Total Anormal", f"${np.nansum(anom_amounts):,.2f}")
+            
+            st.markdown("### Distribution des Anomalies")
+            col_anom4, col_anom5 = st.columns(2)
+            
+            with col_anom4:
+                # Anomalies par catégorie
+                anom_by_category = bundle['anom_by_category']
+                
+                fig_anom1 = px.bar(
+                    anom_by_category,
+                    x='category',
+                    y='total',
+                    title="Montant des Anomalies par Catégorie",
+                    labels={'total': 'Montant (USD)', 'category': 'Catégorie'},
+                    color='total',
+                    color_continuous_scale='Reds'
+                )
+                fig_anom1.update_layout(xaxis_tickangle=45, uirevision='fig_anom1')
+                st.plotly_chart(fig_anom1, use_container_width=True)
+            
+            with col_anom5:
+                # Distribution des montants d'anomalies : les classes sont calculées ici,
+                # seules les 30 barres sont envoyées au navigateur
+                counts, edges = np.histogram(anom_amounts[~np.isnan(anom_amounts)], bins=30)
+                centers = 0.5 * (edges[:-1] + edges[1:])
+                fig_anom2 = go.Figure(go.Bar(x=centers, y=counts, marker_color='red'))
+                fig_anom2.update_layout(
+                    title="Distribution des Montants d'Anomalies",
+                    xaxis_title='Montant (USD)',
+                    yaxis_title='Nombre',
+                    bargap=0,
+                    uirevision='fig_anom2'
+                )
+                st.plotly_chart(fig_anom2, use_container_width=True)
+            
+            # Anomalies par localisation
+            if 'anom_by_location' in bundle:
+                anom_by_location = bundle['anom_by_location']
+                
+                fig_anom3 = px.bar(
+                    anom_by_location,
+                    x='location',
+                    y='count',
+                    title="Nombre d'Anomalies par Localisation (Top 15)",
+                    labels={'count': "Nombre d'anomalies", 'location': 'Localisation'},
+                    color='count',
+                    color_continuous_scale='Oranges'
+                )
+                fig_anom3.update_layout(xaxis_tickangle=45, uirevision='fig_anom3')
+                st.plotly_chart(fig_anom3, use_container_width=True)
+            
+            st.markdown("### Tableau des Anomalies")
+            show_df(anomalies_df, ANOMALY_DISPLAY_COLUMNS)
+        else:
+            st.success("✅ Aucune anomalie détectée dans les données.")
+    else:
+        st.warning("La colonne is_anomaly n'est pas disponible.")
+
+@st.fragment
+def render_tab_advanced(orders_df, bundle):
+    """Onglet Analyse Avancée : segments, satisfaction et répartitions"""
+    st.subheader("📊 Analyse Avancée - Segments & Satisfaction")
+    
+    # Revenu par segment client
+    st.markdown("### 💰 Revenu Total par Segment Client")
+    if 'customer_segment' in orders_df.columns:
+        revenue_by_segment = bundle['revenue_by_segment']
+        
+        col_adv1, col_adv2 = st.columns(2)
+        
+        with col_adv1:
+            fig_seg1 = px.bar(
+                revenue_by_segment,
+                x='segment',
+                y='total_revenue',
+                title="Revenus Totaux par Segment",
+                labels={'total_revenue': 'Revenus (USD)', 'segment': 'Segment Client'},
+                color='total_revenue',
+                color_continuous_scale='Blues'
+            )
+            fig_seg1.update_layout(uirevision='fig_seg1')
+            st.plotly_chart(fig_seg1, use_container_width=True)
+        
+        with col_adv2:
+            fig_seg2 = px.bar(
+                revenue_by_segment,
+                x='segment',
+                y='count',
+                title="Nombre de Commandes par Segment",
+                labels={'count': 'Nombre de commandes', 'segment': 'Segment Client'},
+                color='segment',
+                color_discrete_sequence=px.colors.qualitative.Set3
+            )
+            fig_seg2.update_layout(uirevision='fig_seg2')
+            st.plotly_chart(fig_seg2, use_container_width=True)
+        
+        st.dataframe(revenue_by_segment, use_container_width=True, hide_index=True)
+    else:
+        st.warning("La colonne customer_segment n'est pas disponible.")
+    
+    st.markdown("---")
+    
+    # Satisfaction par catégorie de produit
+    st.markdown("### 😊 Analyse de Satisfaction par Catégorie")
+    if 'satisfaction_level' in orders_df.columns and 'category' in orders_df.columns:
+        satisfaction_by_category = bundle['satisfaction_by_category']
+        pivot_satisfaction = bundle['pivot_satisfaction']
+        
+        col_adv3, col_adv4 = st.columns(2)
+        
+        with col_adv3:
+            # Heatmap satisfaction par catégorie
+            fig_sat1 = px.imshow(
+                pivot_satisfaction,
+                labels=dict(x="Niveau de Satisfaction", y="Catégorie", color="Nombre de commandes"),
+                title="Heatmap: Satisfaction par Catégorie",
+                color_continuous_scale='RdYlBu',
+                aspect="auto"
+            )
+            st.plotly_chart(fig_sat1, use_container_width=True)
+        
+        with col_adv4:
+            # Répartition de la satisfaction globale
+            satisfaction_dist = bundle['satisfaction_dist']
+            # Utiliser une palette de couleurs adaptée pour la satisfaction (vert = bon, rouge = mauvais)
+            satisfaction_colors = {
+                'Very Satisfied': '#2ca02c',  # Vert foncé
+                'Satisfied': '#98df8a',       # Vert clair
+                'Neutral': '#ffbb78',         # Orange
+                'Dissatisfied': '#d62728'     # Rouge
+            }
+            color_map = [satisfaction_colors.get(name, '#1f77b4') for name in satisfaction_dist.index]
+            fig_sat2 = go.Figure(go.Pie(
+                labels=satisfaction_dist.index.tolist(),
+                values=satisfaction_dist.values,
+                hole=0.4,
+                marker_colors=color_map
+            ))
+            fig_sat2.update_layout(title="Répartition Globale de la Satisfaction", uirevision='fig_sat2')
+            st.plotly_chart(fig_sat2, use_container_width=True)
+        
+        # Graphique en barres groupées : une trace par niveau de satisfaction, lue dans la matrice déjà calculée
+        categories = pivot_satisfaction.index.tolist()
+        fig_sat3 = go.Figure([
+            go.Bar(name=str(level), x=categories, y=pivot_satisfaction[level].to_numpy())
+            for level in pivot_satisfaction.columns
+        ])
+        fig_sat3.update_layout(
+            title="Nombre de Commandes par Catégorie et Niveau de Satisfaction",
+            xaxis_title='Catégorie',
+            yaxis_title='Nombre de commandes',
+            legend_title_text='Satisfaction',
+            barmode='group',
+            xaxis_tickangle=45,
+            uirevision='fig_sat3'
+        )
+        st.plotly_chart(fig_sat3, use_container_width=True)
+        
+        show_df(satisfaction_by_category.sort_values('count', ascending=False))
+    else:
+        st.warning("Les colonnes satisfaction_level et category ne sont pas disponibles.")
+    
+    st.markdown("---")
+    
+    # Analyses supplémentaires
+    st.markdown("### 📈 Analyses Supplémentaires")
+    
+    col_adv5, col_adv6 = st.columns(2)
+    
+    with col_adv5:
+        if 'amount_category' in orders_df.columns:
+            st.markdown("#### Répartition par Catégorie de Montant")
+            amount_cat_dist = bundle['amount_category_dist']
+            fig_amt = px.bar(
+                x=amount_cat_dist.index,
+                y=amount_cat_dist.values,
+                title="Répartition des Commandes par Catégorie de Montant",
+                labels={'x': 'Catégorie de Montant', 'y': 'Nombre de commandes'},
+                color=amount_cat_dist.values,
+                color_continuous_scale='Viridis'
+            )
+            fig_amt.update_layout(uirevision='fig_amt')
+            st.plotly_chart(fig_amt, use_container_width=True)
+    
+    with col_adv6:
+        if 'frequency_category' in orders_df.columns:
+            st.markdown("#### Répartition par Fréquence")
+            freq_dist = bundle['frequency_category_dist']
+            fig_freq = go.Figure(go.Pie(labels=freq_dist.index.tolist(), values=freq_dist.values, hole=0.4))
+            fig_freq.update_layout(title="Répartition par Catégorie de Fréquence", uirevision='fig_freq')
+            st.plotly_chart(fig_freq, use_container_width=True)
+
+@st.fragment
+def render_latest_orders(orders_df):
+    """Tableau filtrable des dernières commandes (les filtres ne relancent que ce fragment)"""
+    st.markdown("---")
+    st.subheader("📋 Dernières commandes (streaming)")
+    
+    # Options des filtres : modalités déjà dédupliquées et triées des colonnes Categorical,
+    # recalculées uniquement quand une nouvelle version des commandes est chargée
+    options_key = orders_fingerprint(orders_df)
+    if st.session_state.get('filter_options_key') != options_key:
+        st.session_state['filter_options'] = {
+            col: orders_df[col].cat.categories.tolist() if col in orders_df.columns else []
+            for col in ('category', 'location')
+        }
+        st.session_state['filter_options_key'] = options_key
+    filter_options = st.session_state['filter_options']
+    
+    # Filtres
+    col_f1, col_f2, col_f3 = st.columns(3)
+    with col_f1:
+        categories_filter = st.multiselect(
+            "Filtrer par catégorie",
+            options=filter_options['category'],
+            default=[]
+        )
+    with col_f2:
+        locations_filter = st.multiselect(
+            "Filtrer par localisation",
+            options=filter_options['location'],
+            default=[]
+        )
+    with col_f3:
+        limit_display = st.slider("Nombre de lignes à afficher", 10, 500, 100)
+    
+    # Appliquer les filtres : un seul masque booléen, sans copie intermédiaire du DataFrame
+    mask = np.ones(len(orders_df), dtype=bool)
+    if categories_filter:
+        mask &= orders_df['category'].isin(categories_filter).to_numpy()
+    if locations_filter:
+        mask &= orders_df['location'].isin(locations_filter).to_numpy()
+    filtered_count = int(mask.sum())
+    
+    # Afficher le tableau (inclure les nouvelles colonnes enrichies)
+    available_columns = [col for col in LATEST_ORDERS_DISPLAY_COLUMNS if col in orders_df.columns]
+    
+    # Seules les lignes affichées sont extraites, puis projetées sur les colonnes du tableau
+    displayed_rows = np.flatnonzero(mask)[:limit_display]
+    st.dataframe(
+        orders_df.iloc[displayed_rows].loc[:, available_columns],
+        use_container_width=True,
+        hide_index=True
+    )
+    
+    st.caption(f"Affiche {len(displayed_rows)} lignes sur {filtered_count} total")
+
 # Métriques principales
 st.subheader("📊 Métriques en temps réel")
 
+# Tant que la table n'est pas modifiée, les rerun réutilisent les données en cache sans requête BigQuery
+data_version = current_data_version(refresh_interval)
+# Passe à True si une récupération échoue ou si aucune commande n'est chargée (voir watch_table_changes)
+st.session_state['last_run_failed'] = False
+
 try:
-    orders_df = fetch_latest_orders(limit=10000)
+    orders_df, dashboard_data = fetch_all(limit=10000, columns=DASHBOARD_COLUMNS, data_version=data_version)
     
     if orders_df.empty:
+        st.session_state['last_run_failed'] = True
         st.warning("⚠️ Aucune donnée trouvée dans BigQuery. Vérifiez que le Consumer a traité des fichiers.")
     else:
+        # Métriques agrégées côté BigQuery (une seule ligne au lieu de 10 000)
+        kpis_df = dashboard_data['kpis']
+        kpis = kpis_df.iloc[0] if not kpis_df.empty else {}
+        
         # Première ligne de métriques
         col1, col2, col3, col4 = st.columns(4)
         
-        total_orders = len(orders_df)
-        total_revenue = orders_df['purchase_amount_usd'].sum() if 'purchase_amount_usd' in orders_df.columns else 0
-        avg_order_value = orders_df['purchase_amount_usd'].mean() if 'purchase_amount_usd' in orders_df.columns else 0
-        avg_rating = orders_df['review_rating'].mean() if 'review_rating' in orders_df.columns else 0
+        total_orders = int(kpis.get('total_orders', 0))
+        total_revenue = float(kpis.get('total_revenue', 0))
+        avg_order_value = float(kpis.get('avg_order_value', 0))
+        avg_rating = float(kpis.get('avg_rating', 0))
         
         col1.metric("Total Commandes", f"{total_orders:,}")
         col2.metric("Revenus Total", f"${total_revenue:,.2f}")
@@ -344,16 +1468,19 @@ try:
         col5, col6, col7, col8 = st.columns(4)
         
         # Métriques basées sur les nouvelles colonnes
-        anomalies_count = orders_df['is_anomaly'].sum() if 'is_anomaly' in orders_df.columns else 0
-        total_profit = orders_df['estimated_profit_usd'].sum() if 'estimated_profit_usd' in orders_df.columns else 0
-        vip_customers = len(orders_df[orders_df['customer_segment'] == 'VIP']) if 'customer_segment' in orders_df.columns else 0
-        final_revenue = orders_df['final_amount_usd'].sum() if 'final_amount_usd' in orders_df.columns else total_revenue
+        anomalies_count = int(kpis.get('anomalies_count', 0))
+        total_profit = float(kpis.get('total_profit', 0))
+        vip_customers = int(kpis.get('vip_customers', 0))
+        final_revenue = float(kpis.get('final_revenue', total_revenue))
         
         col5.metric("🚨 Anomalies", f"{anomalies_count:,}", delta=f"{(anomalies_count/total_orders*100):.1f}%" if total_orders > 0 else "0%")
         col6.metric("💰 Profit Estimé", f"${total_profit:,.2f}")
         col7.metric("👑 Clients VIP", f"{vip_customers:,}")
         col8.metric("💵 Revenus Finaux", f"${final_revenue:,.2f}")
         
+        # Tous les agrégats des onglets, calculés une seule fois par version des commandes
+        bundle = compute_bundle(orders_df)
+        
         # Graphiques dans des onglets
         tab1, tab2, tab3, tab4, tab5, tab6, tab7, tab8 = st.tabs([
             "📈 Vue d'ensemble", 
@@ -367,662 +1494,54 @@ try:
         ])
         
         with tab1:
-            st.subheader("Dernières commandes - Vue d'ensemble")
-            
-            # Graphique temporal des commandes
-            if 'processed_time' in orders_df.columns:
-                orders_df['processed_time'] = pd.to_datetime(orders_df['processed_time'])
-                orders_df['hour'] = orders_df['processed_time'].dt.floor('H')
-                hourly_orders = orders_df.groupby('hour').agg({
-                    'purchase_amount_usd': ['count', 'sum']
-                }).reset_index()
-                hourly_orders.columns = ['hour', 'count', 'revenue']
-                
-                col_left, col_right = st.columns(2)
-                
-                with col_left:
-                    fig1 = go.Figure()
-                    fig1.add_trace(go.Scatter(
-                        x=hourly_orders['hour'],
-                        y=hourly_orders['count'],
-                        mode='lines+markers',
-                        name='Nombre de commandes',
-                        line=dict(color='#1f77b4', width=2),
-                        fill='tonexty'
-                    ))
-                    fig1.update_layout(
-                        title="Évolution du nombre de commandes (par heure)",
-                        xaxis_title="Heure",
-                        yaxis_title="Nombre de commandes",
-                        hovermode='x unified',
-                        height=400
-                    )
-                    st.plotly_chart(fig1, use_container_width=True)
-                
-                with col_right:
-                    fig2 = go.Figure()
-                    fig2.add_trace(go.Scatter(
-                        x=hourly_orders['hour'],
-                        y=hourly_orders['revenue'],
-                        mode='lines+markers',
-                        name='Revenus (USD)',
-                        line=dict(color='#2ca02c', width=2),
-                        fill='tonexty'
-                    ))
-                    fig2.update_layout(
-                        title="Évolution des revenus (par heure)",
-                        xaxis_title="Heure",
-                        yaxis_title="Revenus (USD)",
-                        hovermode='x unified',
-                        height=400
-                    )
-                    st.plotly_chart(fig2, use_container_width=True)
-            
-            # Top catégories
-            st.markdown("### Top Catégories")
-            col_cat1, col_cat2 = st.columns(2)
-            
-            with col_cat1:
-                category_counts = orders_df['category'].value_counts().head(10)
-                fig3 = px.bar(
-                    x=category_counts.values,
-                    y=category_counts.index,
-                    orientation='h',
-                    title="Top 10 Catégories (Volume)",
-                    labels={'x': 'Nombre de commandes', 'y': 'Catégorie'},
-                    color=category_counts.values,
-                    color_continuous_scale='Blues'
-                )
-                fig3.update_layout(yaxis={'categoryorder': 'total ascending'}, height=400)
-                st.plotly_chart(fig3, use_container_width=True)
-            
-            with col_cat2:
-                category_revenue = orders_df.groupby('category')['purchase_amount_usd'].sum().sort_values(ascending=False).head(10)
-                fig4 = px.bar(
-                    x=category_revenue.values,
-                    y=category_revenue.index,
-                    orientation='h',
-                    title="Top 10 Catégories (Revenus)",
-                    labels={'x': 'Revenus (USD)', 'y': 'Catégorie'},
-                    color=category_revenue.values,
-                    color_continuous_scale='Greens'
-                )
-                fig4.update_layout(yaxis={'categoryorder': 'total ascending'}, height=400)
-                st.plotly_chart(fig4, use_container_width=True)
-            
-            # Distribution des montants
-            st.markdown("### Distribution des Montants")
-            fig5 = px.histogram(
-                orders_df,
-                x='purchase_amount_usd',
-                nbins=50,
-                title="Distribution des montants de commandes",
-                labels={'purchase_amount_usd': 'Montant (USD)', 'count': 'Nombre de commandes'}
-            )
-            st.plotly_chart(fig5, use_container_width=True)
+            render_tab_overview(dashboard_data, bundle)
         
         with tab2:
-            st.subheader("Préférences par tranche d'âge")
-            age_df = fetch_age_preferences()
-            
-            if not age_df.empty:
-                col_a1, col_a2 = st.columns(2)
-                
-                with col_a1:
-                    fig_age1 = px.bar(
-                        age_df,
-                        x='age_bucket',
-                        y='orders',
-                        title="Nombre de commandes par tranche d'âge",
-                        labels={'orders': 'Nombre de commandes', 'age_bucket': 'Tranche d\'âge'},
-                        color='orders',
-                        color_continuous_scale='Viridis'
-                    )
-                    st.plotly_chart(fig_age1, use_container_width=True)
-                
-                with col_a2:
-                    fig_age2 = px.bar(
-                        age_df,
-                        x='age_bucket',
-                        y='avg_spend',
-                        title="Dépense moyenne par tranche d'âge",
-                        labels={'avg_spend': 'Dépense moyenne (USD)', 'age_bucket': 'Tranche d\'âge'},
-                        color='avg_spend',
-                        color_continuous_scale='Plasma'
-                    )
-                    st.plotly_chart(fig_age2, use_container_width=True)
-                
-                col_a3, col_a4 = st.columns(2)
-                
-                with col_a3:
-                    fig_age3 = px.bar(
-                        age_df,
-                        x='age_bucket',
-                        y='avg_rating',
-                        title="Note moyenne par tranche d'âge",
-                        labels={'avg_rating': 'Note moyenne', 'age_bucket': 'Tranche d\'âge'},
-                        color='avg_rating',
-                        color_continuous_scale='Viridis'
-                    )
-                    st.plotly_chart(fig_age3, use_container_width=True)
-                
-                with col_a4:
-                    if 'top_category' in age_df.columns:
-                        fig_age4 = px.bar(
-                            age_df,
-                            x='age_bucket',
-                            y='top_category',
-                            orientation='h',
-                            title="Catégorie préférée par tranche d'âge",
-                            labels={'top_category': 'Catégorie', 'age_bucket': 'Tranche d\'âge'},
-                            color='age_bucket'
-                        )
-                        st.plotly_chart(fig_age4, use_container_width=True)
-                
-                st.markdown("### Tableau détaillé")
-                st.dataframe(age_df, use_container_width=True, hide_index=True)
-            else:
-                st.info("Les vues analytiques ne sont pas encore disponibles. Assurez-vous que les vues BigQuery sont créées.")
+            render_tab_age(dashboard_data)
         
         with tab3:
-            st.subheader("Préférences par genre")
-            gender_df = fetch_gender_preferences()
-            
-            if not gender_df.empty:
-                col_g1, col_g2 = st.columns(2)
-                
-                with col_g1:
-                    fig_gen1 = px.pie(
-                        gender_df,
-                        values='orders',
-                        names='gender',
-                        title="Répartition des commandes par genre",
-                        hole=0.4
-                    )
-                    st.plotly_chart(fig_gen1, use_container_width=True)
-                
-                with col_g2:
-                    fig_gen2 = px.bar(
-                        gender_df,
-                        x='gender',
-                        y='avg_spend',
-                        title="Dépense moyenne par genre",
-                        labels={'avg_spend': 'Dépense moyenne (USD)', 'gender': 'Genre'},
-                        color='gender',
-                        color_discrete_sequence=px.colors.qualitative.Set2
-                    )
-                    st.plotly_chart(fig_gen2, use_container_width=True)
-                
-                col_g3, col_g4 = st.columns(2)
-                
-                with col_g3:
-                    fig_gen3 = px.bar(
-                        gender_df,
-                        x='gender',
-                        y='avg_rating',
-                        title="Note moyenne par genre",
-                        labels={'avg_rating': 'Note moyenne', 'gender': 'Genre'},
-                        color='gender',
-                        color_discrete_sequence=px.colors.qualitative.Set3
-                    )
-                    st.plotly_chart(fig_gen3, use_container_width=True)
-                
-                with col_g4:
-                    if 'top_category' in gender_df.columns:
-                        fig_gen4 = px.bar(
-                            gender_df,
-                            x='gender',
-                            y='top_category',
-                            orientation='h',
-                            title="Catégorie préférée par genre",
-                            labels={'top_category': 'Catégorie', 'gender': 'Genre'},
-                            color='gender',
-                            color_discrete_sequence=px.colors.qualitative.Pastel
-                        )
-                        st.plotly_chart(fig_gen4, use_container_width=True)
-                
-                st.markdown("### Tableau détaillé")
-                st.dataframe(gender_df, use_container_width=True, hide_index=True)
-            else:
-                st.info("Les vues analytiques ne sont pas encore disponibles.")
+            render_tab_gender(dashboard_data)
         
         with tab4:
-            st.subheader("Préférences par localisation")
-            location_df = fetch_location_preferences()
-            
-            if not location_df.empty:
-                fig_loc1 = px.bar(
-                    location_df.head(20),
-                    x='location',
-                    y='orders',
-                    title="Top 20 Localisations (Nombre de commandes)",
-                    labels={'orders': 'Nombre de commandes', 'location': 'Localisation'},
-                    color='orders',
-                    color_continuous_scale='Blues'
-                )
-                fig_loc1.update_xaxes(tickangle=45)
-                st.plotly_chart(fig_loc1, use_container_width=True)
-                
-                col_loc1, col_loc2 = st.columns(2)
-                
-                with col_loc1:
-                    fig_loc2 = px.bar(
-                        location_df.head(15),
-                        x='location',
-                        y='avg_spend',
-                        title="Dépense moyenne par localisation (Top 15)",
-                        labels={'avg_spend': 'Dépense moyenne (USD)', 'location': 'Localisation'},
-                        color='avg_spend',
-                        color_continuous_scale='Greens'
-                    )
-                    fig_loc2.update_xaxes(tickangle=45)
-                    st.plotly_chart(fig_loc2, use_container_width=True)
-                
-                with col_loc2:
-                    # Graphique en treemap si disponible
-                    if len(location_df) > 0:
-                        fig_loc3 = px.treemap(
-                            location_df.head(20),
-                            path=['location'],
-                            values='orders',
-                            title="Répartition des commandes par localisation (Treemap)",
-                            color='avg_spend',
-                            color_continuous_scale='Viridis'
-                        )
-                        st.plotly_chart(fig_loc3, use_container_width=True)
-                
-                st.markdown("### Tableau détaillé")
-                st.dataframe(location_df, use_container_width=True, hide_index=True)
-            else:
-                st.info("Les vues analytiques ne sont pas encore disponibles.")
+            render_tab_location(dashboard_data)
         
         with tab5:
-            st.subheader("Analyse combinée Âge × Genre × Catégorie")
-            age_gender_df = fetch_age_gender_category()
-            
-            if not age_gender_df.empty:
-                # Heatmap
-                pivot_df = age_gender_df.pivot_table(
-                    index='age_bucket',
-                    columns='gender',
-                    values='orders',
-                    aggfunc='sum',
-                    fill_value=0
-                )
-                
-                fig_heat = px.imshow(
-                    pivot_df,
-                    labels=dict(x="Genre", y="Tranche d'âge", color="Nombre de commandes"),
-                    title="Heatmap: Commandes par Âge et Genre",
-                    color_continuous_scale='YlOrRd',
-                    aspect="auto"
-                )
-                st.plotly_chart(fig_heat, use_container_width=True)
-                
-                # Graphique 3D ou barres groupées
-                fig_comb = px.bar(
-                    age_gender_df.head(30),
-                    x='category',
-                    y='orders',
-                    color='gender',
-                    facet_row='age_bucket',
-                    title="Commandes par Catégorie, Genre et Âge (Top 30)",
-                    labels={'orders': 'Nombre de commandes', 'category': 'Catégorie'}
-                )
-                fig_comb.update_xaxes(tickangle=45)
-                st.plotly_chart(fig_comb, use_container_width=True)
-                
-                st.markdown("### Tableau détaillé")
-                st.dataframe(age_gender_df, use_container_width=True, hide_index=True)
-            else:
-                st.info("Les vues analytiques ne sont pas encore disponibles.")
+            render_tab_combinations(dashboard_data)
         
         with tab6:
-            st.subheader("👑 Analyse des Clients VIP avec Achats Premium")
-            
-            # Filtrer les clients VIP avec achats Premium
-            if 'customer_segment' in orders_df.columns and 'amount_category' in orders_df.columns:
-                vip_premium_df = orders_df[(orders_df['customer_segment'] == 'VIP') & 
-                                          (orders_df['amount_category'] == 'Premium')].copy()
-                
-                if not vip_premium_df.empty:
-                    col_vip1, col_vip2 = st.columns(2)
-                    
-                    with col_vip1:
-                        st.metric("Nombre de transactions VIP Premium", len(vip_premium_df))
-                        st.metric("Revenus VIP Premium", f"${vip_premium_df['purchase_amount_usd'].sum():,.2f}")
-                    
-                    with col_vip2:
-                        avg_vip_premium = vip_premium_df['purchase_amount_usd'].mean()
-                        avg_clv_vip = vip_premium_df['estimated_clv'].mean() if 'estimated_clv' in vip_premium_df.columns else 0
-                        st.metric("Panier Moyen VIP Premium", f"${avg_vip_premium:,.2f}")
-                        st.metric("CLV Moyen", f"${avg_clv_vip:,.2f}")
-                    
-                    # Répartition par catégorie pour VIP Premium
-                    st.markdown("### Répartition par Catégorie")
-                    vip_category = vip_premium_df.groupby('category').agg({
-                        'purchase_amount_usd': ['count', 'sum', 'mean'],
-                        'estimated_clv': 'mean' if 'estimated_clv' in vip_premium_df.columns else 'count'
-                    }).reset_index()
-                    vip_category.columns = ['category', 'count', 'total_revenue', 'avg_amount', 'avg_clv']
-                    vip_category = vip_category.sort_values('total_revenue', ascending=False)
-                    
-                    col_vip3, col_vip4 = st.columns(2)
-                    
-                    with col_vip3:
-                        fig_vip1 = px.bar(
-                            vip_category,
-                            x='category',
-                            y='total_revenue',
-                            title="Revenus par Catégorie (VIP Premium)",
-                            labels={'total_revenue': 'Revenus (USD)', 'category': 'Catégorie'},
-                            color='total_revenue',
-                            color_continuous_scale='Gold'
-                        )
-                        fig_vip1.update_xaxes(tickangle=45)
-                        st.plotly_chart(fig_vip1, use_container_width=True)
-                    
-                    with col_vip4:
-                        if 'loyalty_score' in vip_premium_df.columns:
-                            loyalty_dist = vip_premium_df['loyalty_score'].value_counts()
-                            fig_vip2 = px.pie(
-                                values=loyalty_dist.values,
-                                names=loyalty_dist.index,
-                                title="Répartition par Score de Fidélité (VIP Premium)",
-                                hole=0.4
-                            )
-                            st.plotly_chart(fig_vip2, use_container_width=True)
-                    
-                    st.markdown("### Tableau détaillé VIP Premium")
-                    display_cols_vip = ['processed_time', 'customer_id', 'category', 'item_purchased',
-                                       'purchase_amount_usd', 'estimated_clv', 'loyalty_score', 
-                                       'frequency_category', 'location']
-                    available_cols_vip = [col for col in display_cols_vip if col in vip_premium_df.columns]
-                    st.dataframe(vip_premium_df[available_cols_vip].head(100), use_container_width=True, hide_index=True)
-                else:
-                    st.info("Aucune transaction VIP Premium trouvée.")
-            else:
-                st.warning("Les colonnes customer_segment et amount_category ne sont pas disponibles.")
+            render_tab_vip(orders_df, bundle)
         
         with tab7:
-            st.subheader("🚨 Détection des Transactions Suspectes (Anomalies)")
-            
-            if 'is_anomaly' in orders_df.columns:
-                anomalies_df = orders_df[orders_df['is_anomaly'] == True].copy()
-                
-                if not anomalies_df.empty:
-                    col_anom1, col_anom2, col_anom3 = st.columns(3)
-                    
-                    with col_anom1:
-                        st.metric("🚨 Transactions Anormales", len(anomalies_df))
-                    with col_anom2:
-                        anomaly_rate = (len(anomalies_df) / len(orders_df)) * 100 if len(orders_df) > 0 else 0
-                        st.metric("Taux d'Anomalies", f"{anomaly_rate:.2f}%")
-                    with col_anom3:
-                        st.metric("Montant Total Anormal", f"${anomalies_df['purchase_amount_usd'].sum():,.2f}")
-                    
-                    st.markdown("### Distribution des Anomalies")
-                    col_anom4, col_anom5 = st.columns(2)
-                    
-                    with col_anom4:
-                        # Anomalies par catégorie
-                        anom_by_category = anomalies_df.groupby('category')['purchase_amount_usd'].agg(['count', 'sum']).reset_index()
-                        anom_by_category.columns = ['category', 'count', 'total']
-                        anom_by_category = anom_by_category.sort_values('total', ascending=False)
-                        
-                        fig_anom1 = px.bar(
-                            anom_by_category,
-                            x='category',
-                            y='total',
-                            title="Montant des Anomalies par Catégorie",
-                            labels={'total': 'Montant (USD)', 'category': 'Catégorie'},
-                            color='total',
-                            color_continuous_scale='Reds'
-                        )
-                        fig_anom1.update_xaxes(tickangle=45)
-                        st.plotly_chart(fig_anom1, use_container_width=True)
-                    
-                    with col_anom5:
-                        # Distribution des montants d'anomalies
-                        fig_anom2 = px.histogram(
-                            anomalies_df,
-                            x='purchase_amount_usd',
-                            nbins=30,
-                            title="Distribution des Montants d'Anomalies",
-                            labels={'purchase_amount_usd': 'Montant (USD)', 'count': 'Nombre'},
-                            color_discrete_sequence=['red']
-                        )
-                        st.plotly_chart(fig_anom2, use_container_width=True)
-                    
-                    # Anomalies par localisation
-                    if 'location' in anomalies_df.columns:
-                        anom_by_location = anomalies_df.groupby('location')['purchase_amount_usd'].agg(['count', 'sum']).reset_index()
-                        anom_by_location.columns = ['location', 'count', 'total']
-                        anom_by_location = anom_by_location.sort_values('total', ascending=False).head(15)
-                        
-                        fig_anom3 = px.bar(
-                            anom_by_location,
-                            x='location',
-                            y='count',
-                            title="Nombre d'Anomalies par Localisation (Top 15)",
-                            labels={'count': "Nombre d'anomalies", 'location': 'Localisation'},
-                            color='count',
-                            color_continuous_scale='Oranges'
-                        )
-                        fig_anom3.update_xaxes(tickangle=45)
-                        st.plotly_chart(fig_anom3, use_container_width=True)
-                    
-                    st.markdown("### Tableau des Anomalies")
-                    display_cols_anom = ['processed_time', 'customer_id', 'category', 'purchase_amount_usd',
-                                        'amount_category', 'location', 'customer_segment', 'payment_method']
-                    available_cols_anom = [col for col in display_cols_anom if col in anomalies_df.columns]
-                    st.dataframe(anomalies_df[available_cols_anom], use_container_width=True, hide_index=True)
-                else:
-                    st.success("✅ Aucune anomalie détectée dans les données.")
-            else:
-                st.warning("La colonne is_anomaly n'est pas disponible.")
+            render_tab_anomalies(orders_df, bundle)
         
         with tab8:
-            st.subheader("📊 Analyse Avancée - Segments & Satisfaction")
-            
-            # Revenu par segment client
-            st.markdown("### 💰 Revenu Total par Segment Client")
-            if 'customer_segment' in orders_df.columns:
-                revenue_by_segment = orders_df.groupby('customer_segment').agg({
-                    'purchase_amount_usd': ['sum', 'mean', 'count'],
-                    'estimated_profit_usd': 'sum' if 'estimated_profit_usd' in orders_df.columns else 'count'
-                }).reset_index()
-                revenue_by_segment.columns = ['segment', 'total_revenue', 'avg_revenue', 'count', 'total_profit']
-                revenue_by_segment = revenue_by_segment.sort_values('total_revenue', ascending=False)
-                
-                col_adv1, col_adv2 = st.columns(2)
-                
-                with col_adv1:
-                    fig_seg1 = px.bar(
-                        revenue_by_segment,
-                        x='segment',
-                        y='total_revenue',
-                        title="Revenus Totaux par Segment",
-                        labels={'total_revenue': 'Revenus (USD)', 'segment': 'Segment Client'},
-                        color='total_revenue',
-                        color_continuous_scale='Blues'
-                    )
-                    st.plotly_chart(fig_seg1, use_container_width=True)
-                
-                with col_adv2:
-                    fig_seg2 = px.bar(
-                        revenue_by_segment,
-                        x='segment',
-                        y='count',
-                        title="Nombre de Commandes par Segment",
-                        labels={'count': 'Nombre de commandes', 'segment': 'Segment Client'},
-                        color='segment',
-                        color_discrete_sequence=px.colors.qualitative.Set3
-                    )
-                    st.plotly_chart(fig_seg2, use_container_width=True)
-                
-                st.dataframe(revenue_by_segment, use_container_width=True, hide_index=True)
-            else:
-                st.warning("La colonne customer_segment n'est pas disponible.")
-            
-            st.markdown("---")
-            
-            # Satisfaction par catégorie de produit
-            st.markdown("### 😊 Analyse de Satisfaction par Catégorie")
-            if 'satisfaction_level' in orders_df.columns and 'category' in orders_df.columns:
-                satisfaction_by_category = orders_df.groupby(['category', 'satisfaction_level']).agg({
-                    'purchase_amount_usd': ['count', 'sum']
-                }).reset_index()
-                satisfaction_by_category.columns = ['category', 'satisfaction_level', 'count', 'revenue']
-                
-                col_adv3, col_adv4 = st.columns(2)
-                
-                with col_adv3:
-                    # Heatmap satisfaction par catégorie
-                    pivot_satisfaction = satisfaction_by_category.pivot_table(
-                        index='category',
-                        columns='satisfaction_level',
-                        values='count',
-                        aggfunc='sum',
-                        fill_value=0
-                    )
-                    
-                    # Trier les niveaux de satisfaction dans un ordre logique
-                    satisfaction_order = ['Very Satisfied', 'Satisfied', 'Neutral', 'Dissatisfied']
-                    available_levels = [level for level in satisfaction_order if level in pivot_satisfaction.columns]
-                    if available_levels:
-                        pivot_satisfaction = pivot_satisfaction[available_levels]
-                    
-                    fig_sat1 = px.imshow(
-                        pivot_satisfaction,
-                        labels=dict(x="Niveau de Satisfaction", y="Catégorie", color="Nombre de commandes"),
-                        title="Heatmap: Satisfaction par Catégorie",
-                        color_continuous_scale='RdYlBu',
-                        aspect="auto"
-                    )
-                    st.plotly_chart(fig_sat1, use_container_width=True)
-                
-                with col_adv4:
-                    # Répartition de la satisfaction globale
-                    satisfaction_dist = orders_df['satisfaction_level'].value_counts()
-                    # Utiliser une palette de couleurs adaptée pour la satisfaction (vert = bon, rouge = mauvais)
-                    satisfaction_colors = {
-                        'Very Satisfied': '#2ca02c',  # Vert foncé
-                        'Satisfied': '#98df8a',       # Vert clair
-                        'Neutral': '#ffbb78',         # Orange
-                        'Dissatisfied': '#d62728'     # Rouge
-                    }
-                    color_map = [satisfaction_colors.get(name, '#1f77b4') for name in satisfaction_dist.index]
-                    fig_sat2 = px.pie(
-                        values=satisfaction_dist.values,
-                        names=satisfaction_dist.index,
-                        title="Répartition Globale de la Satisfaction",
-                        hole=0.4,
-                        color_discrete_sequence=color_map
-                    )
-                    st.plotly_chart(fig_sat2, use_container_width=True)
-                
-                # Graphique en barres groupées
-                fig_sat3 = px.bar(
-                    satisfaction_by_category,
-                    x='category',
-                    y='count',
-                    color='satisfaction_level',
-                    title="Nombre de Commandes par Catégorie et Niveau de Satisfaction",
-                    labels={'count': 'Nombre de commandes', 'category': 'Catégorie', 'satisfaction_level': 'Satisfaction'},
-                    barmode='group'
-                )
-                fig_sat3.update_xaxes(tickangle=45)
-                st.plotly_chart(fig_sat3, use_container_width=True)
-                
-                st.dataframe(satisfaction_by_category.sort_values('count', ascending=False), use_container_width=True, hide_index=True)
-            else:
-                st.warning("Les colonnes satisfaction_level et category ne sont pas disponibles.")
-            
-            st.markdown("---")
-            
-            # Analyses supplémentaires
-            st.markdown("### 📈 Analyses Supplémentaires")
-            
-            col_adv5, col_adv6 = st.columns(2)
-            
-            with col_adv5:
-                if 'amount_category' in orders_df.columns:
-                    st.markdown("#### Répartition par Catégorie de Montant")
-                    amount_cat_dist = orders_df['amount_category'].value_counts()
-                    fig_amt = px.bar(
-                        x=amount_cat_dist.index,
-                        y=amount_cat_dist.values,
-                        title="Répartition des Commandes par Catégorie de Montant",
-                        labels={'x': 'Catégorie de Montant', 'y': 'Nombre de commandes'},
-                        color=amount_cat_dist.values,
-                        color_continuous_scale='Viridis'
-                    )
-                    st.plotly_chart(fig_amt, use_container_width=True)
-            
-            with col_adv6:
-                if 'frequency_category' in orders_df.columns:
-                    st.markdown("#### Répartition par Fréquence")
-                    freq_dist = orders_df['frequency_category'].value_counts()
-                    fig_freq = px.pie(
-                        values=freq_dist.values,
-                        names=freq_dist.index,
-                        title="Répartition par Catégorie de Fréquence",
-                        hole=0.4
-                    )
-                    st.plotly_chart(fig_freq, use_container_width=True)
+            render_tab_advanced(orders_df, bundle)
         
         # Table des dernières commandes
-        st.markdown("---")
-        st.subheader("📋 Dernières commandes (streaming)")
-        
-        # Filtres
-        col_f1, col_f2, col_f3 = st.columns(3)
-        with col_f1:
-            categories_filter = st.multiselect(
-                "Filtrer par catégorie",
-                options=orders_df['category'].unique() if 'category' in orders_df.columns else [],
-                default=[]
-            )
-        with col_f2:
-            locations_filter = st.multiselect(
-                "Filtrer par localisation",
-                options=orders_df['location'].unique() if 'location' in orders_df.columns else [],
-                default=[]
-            )
-        with col_f3:
-            limit_display = st.slider("Nombre de lignes à afficher", 10, 500, 100)
-        
-        # Appliquer les filtres
-        filtered_df = orders_df.copy()
-        if categories_filter:
-            filtered_df = filtered_df[filtered_df['category'].isin(categories_filter)]
-        if locations_filter:
-            filtered_df = filtered_df[filtered_df['location'].isin(locations_filter)]
-        
-        # Afficher le tableau (inclure les nouvelles colonnes enrichies)
-        display_columns = ['processed_time', 'customer_id', 'category', 'item_purchased', 
-                          'purchase_amount_usd', 'final_amount_usd', 'amount_category',
-                          'customer_segment', 'satisfaction_level', 'is_anomaly', 
-                          'location', 'review_rating']
-        available_columns = [col for col in display_columns if col in filtered_df.columns]
-        
-        st.dataframe(
-            filtered_df[available_columns].head(limit_display),
-            use_container_width=True,
-            hide_index=True
-        )
-        
-        st.caption(f"Affiche {min(limit_display, len(filtered_df))} lignes sur {len(filtered_df)} total")
+        render_latest_orders(orders_df)
 
 except Exception as e:
+    st.session_state['last_run_failed'] = True
     st.error(f"Erreur lors de la récupération des données: {str(e)}")
     st.exception(e)
     st.info("💡 Vérifiez votre configuration BigQuery et vos credentials GCP")
 
-# Actualisation automatique
+# Actualisation automatique : le fragment est relancé par le navigateur à chaque intervalle (sans bloquer
+# le thread du script) et ne relance toute la page que si la table orders a changé ou si la dernière
+# exécution complète a échoué
+@st.fragment(run_every=refresh_interval)
+def watch_table_changes(data_version):
+    """Relance la page entière dès que la version des données diffère de celle affichée,
+    ou à chaque intervalle tant que la dernière exécution complète a échoué"""
+    # Le premier passage a lieu pendant le rendu de la page : relancer ici bouclerait sans attendre l'intervalle
+    first_pass = st.session_state.pop('watch_first_pass', False)
+    if st.session_state.get('last_run_failed') and not first_pass:
+        st.rerun(scope="app")
+    if current_data_version(refresh_interval) != data_version:
+        st.rerun(scope="app")
+
 if auto_refresh:
-    time.sleep(refresh_interval)
-    st.rerun()
+    st.session_state['watch_first_pass'] = True
+    watch_table_changes(data_version)
 
 